@@ -1,32 +1,44 @@
-from flask import Flask, request, json
+import logging
 
-app = Flask(__name__)
+import orjson
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 
+"""
+Run with: uvicorn alert_server:app --port 5000 --workers 4 --loop uvloop
+"""
 
-@app.route("/")
-def welcome():
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+log = logging.getLogger("alert_server")
+
+app = FastAPI(default_response_class=PlainTextResponse)
+
+
+@app.get("/")
+async def welcome():
     return "Welcome to the Citical Systems Laboratory InfluxDB lab alert test service!"
 
 
-@app.route("/co2", methods=['POST'])
-def co2():
-    data = json.loads(request.data)
-    print("Notification sent to CO2 message: ")
-    print(str(data["_message"]))
-    return "Notification sent to CO2 ! "+str(request.data)
+@app.post("/co2")
+async def co2(request: Request):
+    body = await request.body()
+    data = orjson.loads(body)
+    log.info("Notification sent to CO2 message: ")
+    log.info(str(data["_message"]))
+    return "Notification sent to CO2 ! "+str(body)
 
 
-@app.route("/down", methods=['POST'])
-def down():
-    data = json.loads(request.data)
-    print(str(data["_message"]))
-    print("Notification sent to down")
+@app.post("/down")
+async def down(request: Request):
+    data = orjson.loads(await request.body())
+    log.info(str(data["_message"]))
+    log.info("Notification sent to down")
     return "Notification sent to down"
 
 
-@app.route("/diff", methods=['POST'])
-def diff():
-    data = json.loads(request.data)
-    print(str(data["_message"]))
-    print("Notification sent to diff")
+@app.post("/diff")
+async def diff(request: Request):
+    data = orjson.loads(await request.body())
+    log.info(str(data["_message"]))
+    log.info("Notification sent to diff")
     return "Notification sent to diff"
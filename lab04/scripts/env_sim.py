@@ -1,19 +1,52 @@
-from typing import Callable, Iterable, List, Set, Dict
-from influxdb_client import InfluxDBClient, Point
+from typing import Callable, Iterable, List, Dict
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+from influxdb_client.domain.write_precision import WritePrecision
+from influxdb_client.rest import ApiException
 from numpy.random import random
-from time import sleep
-from datetime import datetime, timedelta
+from time import sleep, monotonic
+from datetime import datetime
+from numba import njit
+import aiohttp
+import asyncio
+import numpy as np
+import pandas as pd
 
 from processes import *
+from processes import _draw_normal
+
+# line protocol escaping of measurement names and of tag keys and values
+_LP_ESCAPE_MEAS = str.maketrans({",": "\\,", " ": "\\ "})
+_LP_ESCAPE_TAG = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ "})
+
+
+@njit(fastmath=True, cache=True)
+def apply_noise(values: np.ndarray, sigmas: np.ndarray, out: np.ndarray) -> np.ndarray:
+    for i in range(values.shape[0]):
+        out[i] = values[i] + sigmas[i] * np.random.standard_normal()
+    return out
+
+
+# compile at import instead of in the first time step
+apply_noise(np.zeros(1), np.zeros(1), np.zeros(1))
 
 
 class Measurement:
-    def __init__(self, process: Process, distortion: Callable[[float], float]):
+    def __init__(self, process: Process, distortion: Callable[[float], float], sigma: float = 0.0):
+        """
+        :param sigma: standard deviation of the Gaussian noise added to the distorted value
+        """
         self.process = process
         self.distortion = distortion
+        self.sigma = sigma
+        # set if the noise is applied in bulk by an Environment
+        self._owner = None
+        self._noise_idx = 0
 
     def get(self):
-        return self.distortion(self.process.get())
+        if self._owner is not None:
+            return self._owner._meas_values[self._noise_idx]
+        value = self.distortion(self.process.get())
+        return value if self.sigma == 0 else value + self.sigma * _draw_normal()
 
 
 class Device(ABC):
@@ -33,6 +66,13 @@ class Device(ABC):
     def get_tags(self):
         pass
 
+    @abstractmethod
+    def get_lp_prefix(self) -> bytes:
+        """
+        Returns the encoded line protocol of the device's points up to the field value.
+        """
+        pass
+
 
 class BasicDevice(Device):
     def __init__(self, name: str, measurement: Measurement, p_skip: float,
@@ -41,14 +81,20 @@ class BasicDevice(Device):
         self.measurement = measurement
         self.p_skip = p_skip
         self.value = measurement.get()
-        self.tags = influx_tags
+        # InfluxDB expects the tags sorted by key
+        self.tags = dict(sorted(influx_tags.items()))
         self.influx_meas = influx_meas
+        # the measurement and the tags do not change, so the line protocol prefix is built once
+        self._lp_prefix = (influx_meas.translate(_LP_ESCAPE_MEAS) + "".join(
+            f",{str(k).translate(_LP_ESCAPE_TAG)}={str(v).translate(_LP_ESCAPE_TAG)}"
+            for (k, v) in self.tags.items()
+        )).encode() + b" value="
 
     def step(self):
         if self.p_skip == 0:
             self.value = self.measurement.get()
-        skip = random() < self.p_skip
-        self.value = None if skip else self.measurement.get()
+            return
+        self.value = None if random() < self.p_skip else self.measurement.get()
 
     def get(self):
         return self.value
@@ -59,6 +105,9 @@ class BasicDevice(Device):
     def get_tags(self):
         return self.tags
 
+    def get_lp_prefix(self) -> bytes:
+        return self._lp_prefix
+
 
 class DoomedDevice(Device):
     def __init__(self, name: str, base_device: Device, lifetime: int):
@@ -80,6 +129,9 @@ class DoomedDevice(Device):
     def get_tags(self):
         return self.base_device.get_tags()
 
+    def get_lp_prefix(self) -> bytes:
+        return self.base_device.get_lp_prefix()
+
 
 class StickyDevice(Device):
     def __init__(self, name: str, base_device: Device, lifetime: int):
@@ -103,68 +155,252 @@ class StickyDevice(Device):
     def get_tags(self):
         return self.base_device.get_tags()
 
+    def get_lp_prefix(self) -> bytes:
+        return self.base_device.get_lp_prefix()
+
 
 class Environment:
-    def __init__(self, processes: Set[Process], devices: Set[Device]):
-        self.processes = processes
-        self.devices = devices
+    def __init__(self, processes: List[Process], devices: List[Device]):
+        # the processes are stepped in the order of their addition,
+        # so a process is stepped after the processes it was built from
+        self.processes: List[Process] = []
+        self.devices: List[Device] = []
+        # encoded line protocol of the points to be written, sent as one batch when full or at least every 10 seconds
+        self._buffer = []
+        self._batch_size = 5000
+        self._flush_interval = 10.0
+        # a failed batch is retried with exponential backoff, like the batching writer of the sync client does
+        self._max_retries = 5
+        self._retry_interval = 5.0
+        self._max_retry_delay = 125.0
+
+        # values of the array-backed processes, which are stepped in bulk (see add_process)
+        self._rng = np.random.default_rng()
+        self._all_values = np.empty(0)
+        self._gauss_idx = np.empty(0, dtype=np.intp)
+        self._gauss_means = np.empty(0)
+        self._gauss_stds = np.empty(0)
+        self._pwc_idx = np.empty(0, dtype=np.intp)
+        self._pwc_tables = np.empty((0, 0))
+        self._pwc_periods = np.empty(0, dtype=np.intp)
+        self._pwc_seasonal = np.empty(0, dtype=bool)
+        self._pwc_t = np.empty(0, dtype=np.intp)
+        self._integ_idx = np.empty(0, dtype=np.intp)
+        self._integ_base_idx = np.empty(0, dtype=np.intp)
+        # the noisy measurements of the devices, whose noise is applied in bulk (see add_device)
+        self._noisy_meas: List[Measurement] = []
+        self._meas_sigmas = np.empty(0)
+        self._meas_values = np.empty(0)
+
+        for process in processes:
+            self.add_process(process)
+        for device in devices:
+            self.add_device(device)
 
     def add_process(self, process: Process) -> Process:
-        self.processes.add(process)
+        """
+        Adds a process to the environment and returns it.
+        Gaussian noise and piecewise constant processes, and integrals of those are bound to the values array
+        of the environment, and stepped together.
+        """
+        if isinstance(process, ArrayProcess) and process.owner is not None:
+            raise ValueError("The process is already added to an environment")
+        if type(process) is GaussianNoiseProcess:
+            self._bind_array_process(process)
+            self._gauss_idx = np.append(self._gauss_idx, process._soa_idx)
+            self._gauss_means = np.append(self._gauss_means, process.mean)
+            self._gauss_stds = np.append(self._gauss_stds, process.std)
+            return process
+        if type(process) is PwConstantProcess:
+            self._bind_array_process(process)
+            self._pwc_idx = np.append(self._pwc_idx, process._soa_idx)
+            # the tables of the processes are the rows of a matrix, padded to the longest period
+            width = max(self._pwc_tables.shape[1], process._period)
+            self._pwc_tables = np.vstack([
+                np.pad(self._pwc_tables, ((0, 0), (0, width - self._pwc_tables.shape[1]))),
+                np.pad(process._table, (0, width - process._period)),
+            ])
+            self._pwc_periods = np.append(self._pwc_periods, process._period)
+            self._pwc_seasonal = np.append(self._pwc_seasonal, process.seasonal)
+            self._pwc_t = np.append(self._pwc_t, process.t)
+            return process
+        # integrals of integrals are stepped one by one, after the integral they are built from
+        if type(process) is IntegratedProcess \
+                and type(process.base_process) in (GaussianNoiseProcess, PwConstantProcess) \
+                and process.base_process.owner is self:
+            self._bind_array_process(process)
+            self._integ_idx = np.append(self._integ_idx, process._soa_idx)
+            self._integ_base_idx = np.append(self._integ_base_idx, process.base_process._soa_idx)
+            return process
+        self.processes.append(process)
         return process
 
+    def _bind_array_process(self, process: ArrayProcess):
+        self._all_values = np.append(self._all_values, process.get())
+        process.bind(self, len(self._all_values) - 1)
+
     def add_device(self, device: Device) -> Device:
-        self.devices.add(device)
+        self.devices.append(device)
+        basic_device = device
+        while hasattr(basic_device, "base_device"):
+            basic_device = basic_device.base_device
+        if isinstance(basic_device, BasicDevice):
+            measurement = basic_device.measurement
+            if measurement.sigma > 0 and measurement._owner is None:
+                self._meas_values = np.append(self._meas_values, measurement.get())
+                self._meas_sigmas = np.append(self._meas_sigmas, measurement.sigma)
+                measurement._owner = self
+                measurement._noise_idx = len(self._noisy_meas)
+                self._noisy_meas.append(measurement)
         return device
 
+    def step_processes(self):
+        self._all_values[self._gauss_idx] = (
+            self._rng.standard_normal(len(self._gauss_idx)) * self._gauss_stds + self._gauss_means
+        )
+        t = self._pwc_t + 1
+        self._pwc_t = np.where(self._pwc_seasonal, t % self._pwc_periods, np.minimum(t, self._pwc_periods - 1))
+        self._all_values[self._pwc_idx] = self._pwc_tables[np.arange(len(self._pwc_idx)), self._pwc_t]
+        self._all_values[self._integ_idx] += self._all_values[self._integ_base_idx]
+        for process in self.processes:
+            process.step()
+        # the devices read the noisy values of their measurements in this time step
+        raw_values = np.fromiter(
+            (m.distortion(m.process.get()) for m in self._noisy_meas), dtype=np.float64, count=len(self._noisy_meas)
+        )
+        apply_noise(raw_values, self._meas_sigmas, self._meas_values)
+
     def run_console(self, dt: int):
+        # the time steps are scheduled dt apart, regardless of how long a step takes
+        next_t = monotonic()
         while True:
             time = datetime.now()
-            for process in self.processes:
-                process.step()
-            for device in self.devices:
-                device.step()
-                print(time, device.name, "value:", device.get(), "tags:", device.tags)
-            sleep(dt)
-
-    def run_influx(self, dt: int, config_file: str, bucket: str):
-        self.client = InfluxDBClient.from_config_file(config_file)
-        self.write_api = self.client.write_api()
-        while True:
-            for process in self.processes:
-                process.step()
+            self.step_processes()
             for device in self.devices:
                 device.step()
-                self.write_device(device, bucket)
-            print(datetime.now())
-            sleep(dt)
-
-    def write_device(self, device: Device, bucket: str):
+                print(time, device.name, "value:", device.get(), "tags:", device.get_tags())
+            next_t += dt
+            sleep(max(0.0, next_t - monotonic()))
+
+    async def run_influx(self, dt: int, config_file: str, bucket: str):
+        async with InfluxDBClientAsync.from_config_file(config_file, enable_gzip=True) as client:
+            self.client = client
+            self.write_api = client.write_api()
+            # the batches are written in the background, while the simulation goes on
+            pending = set()
+            # basic devices are read directly, the others through the Device interface
+            basic_devices = [d for d in self.devices if type(d) is BasicDevice]
+            other_devices = [d for d in self.devices if type(d) is not BasicDevice]
+            next_t = last_flush = monotonic()
+            # the timestamps advance with the steps, so consecutive steps never share a second
+            start_ts = int(datetime.now().timestamp())
+            step = 0
+            try:
+                while True:
+                    self.step_processes()
+                    # the simulation ticks in whole seconds, so the points are timestamped with second precision
+                    ts = f" {start_ts + step * dt}".encode()
+                    step += 1
+                    for device in basic_devices:
+                        device.step()
+                        value = device.value
+                        if value is not None:
+                            self._buffer.append(device._lp_prefix + str(float(value)).encode() + ts)
+                    for device in other_devices:
+                        device.step()
+                        self.write_device(device, ts)
+                    if len(self._buffer) >= self._batch_size or monotonic() - last_flush >= self._flush_interval:
+                        self._flush(bucket, pending)
+                        last_flush = monotonic()
+                    print(datetime.now())
+                    next_t += dt
+                    await asyncio.sleep(max(0.0, next_t - monotonic()))
+            finally:
+                self._flush(bucket, pending)
+                await asyncio.gather(*pending)
+
+    def _flush(self, bucket: str, pending: set):
+        if not self._buffer:
+            return
+        task = asyncio.create_task(self._write_batch(bucket, b"\n".join(self._buffer)))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        self._buffer = []
+
+    async def _write_batch(self, bucket: str, batch: bytes):
+        delay = self._retry_interval
+        for attempt in range(self._max_retries + 1):
+            try:
+                await self.write_api.write(bucket, record=batch, write_precision=WritePrecision.S)
+                return
+            except ApiException as e:
+                # only throttling and server errors are transient
+                if e.status is not None and e.status != 429 and e.status < 500:
+                    print("Failed to write batch:", e)
+                    return
+                error = e
+                wait = _retry_after(e, delay)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                wait = delay
+            if attempt < self._max_retries:
+                await asyncio.sleep(wait)
+                delay = min(2 * delay, self._max_retry_delay)
+        # the batch is dropped, the simulation goes on
+        print(f"Failed to write batch after {self._max_retries} retries:", error)
+
+    def write_device(self, device: Device, ts: bytes):
+        """
+        :param ts: the encoded timestamp of the point, preceded by a space
+        """
         value = device.get()
         if value is None:
             return
-        p = Point(device.get_influx_meas())
-        p.field("value", float(value))
-        for (key, val) in device.get_tags().items():
-            p.tag(key, val)
-        self.write_api.write(bucket, record=p)
-
-    def generate_data(self, steps: int, dt: int, filename: str = "env_sim_gen.csv"):
-        time = datetime.now()
-        with open(filename, 'w') as file:
-            # tags are hardcoded for now
-            file.write("#datatype measurement,double,dateTime,tag,tag")
-            file.write("m,value,time,room_id,sensor_id")
-            for _ in range(steps):
-                for p in self.processes:
-                    p.step()
-                for d in self.devices:
+        self._buffer.append(device.get_lp_prefix() + str(float(value)).encode() + ts)
+
+    def generate_data(self, steps: int, dt: int, filename: str = "env_sim_gen.csv", chunk: int = 4096):
+        # tags are hardcoded for now
+        meas = np.array([d.get_influx_meas() for d in self.devices], dtype=object)
+        room_ids = np.array([d.get_tags()['room_id'] for d in self.devices], dtype=object)
+        sensor_ids = np.array([d.get_tags()['sensor_id'] for d in self.devices], dtype=object)
+
+        # the values of the devices are collected for a chunk of time steps, then written at once
+        values = np.empty((chunk, len(self.devices)))
+        times = np.empty(chunk, dtype='datetime64[s]')
+        time = np.datetime64(int(datetime.now().timestamp()), 's')
+        with open(filename, 'w', buffering=1 << 20) as file:
+            file.write("#datatype measurement,double,dateTime,tag,tag\n")
+            file.write("m,value,time,room_id,sensor_id\n")
+            for step in range(steps):
+                row = step % chunk
+                self.step_processes()
+                for (i, d) in enumerate(self.devices):
                     d.step()
-                    file.write(
-                        f"{d.get_influx_meas()},{d.get()},{time},{d.get_tags()['room_id']},{d.get_tags()['sensor_id']}"
-                    )
-                    d.get()
-                time += timedelta(seconds=dt)
+                    value = d.get()
+                    values[row, i] = np.nan if value is None else value
+                times[row] = time
+                time += np.timedelta64(dt, 's')
+                if row == chunk - 1 or step == steps - 1:
+                    n_rows = row + 1
+                    pd.DataFrame({
+                        "m": np.tile(meas, n_rows),
+                        "value": values[:n_rows].ravel(),
+                        "time": np.repeat(np.datetime_as_string(times[:n_rows], timezone='UTC'), len(self.devices)),
+                        "room_id": np.tile(room_ids, n_rows),
+                        "sensor_id": np.tile(sensor_ids, n_rows),
+                    }).dropna(subset=["value"]).to_csv(file, header=False, index=False)
+
+
+def _retry_after(e: ApiException, default: float) -> float:
+    """
+    Returns the delay requested by the Retry-After header of the response, or the default if there is none.
+    """
+    value = e.headers.get("Retry-After") if e.headers else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # missing, or given as an HTTP date
+        return default
 
 
 def identity(x):
@@ -172,7 +408,7 @@ def identity(x):
 
 
 def add_gauss_noise(sigma: float) -> Callable[[float], float]:
-    return lambda x: x+randn()*sigma
+    return lambda x: x+_draw_normal()*sigma
 
 
 def perfect_device(name: str, p: Process, influx_meas: str, tags: Dict[str, str]) -> Device:
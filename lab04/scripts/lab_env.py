@@ -1,12 +1,13 @@
 from env_sim import *
 from numpy.random import randint
 import argparse
+import asyncio
 
 """
 This is the simulated environment used for the Time Series lab of the Cyber Physical Systems course.
 """
 
-env = Environment(set(), set())
+env = Environment([], [])
 parser = argparse.ArgumentParser(description="Simulator for the CPS InfluxDB lab.")
 
 parser.add_argument('--co2', action='store_true')
@@ -71,8 +72,8 @@ def create_room(env: Environment, room_id: str,
     in_temp_process = env.add_process(SumProcess(
         [in_temp_mean_process, in_temp_noise_process]
     ))
-    meas_in_temp_1 = Measurement(in_temp_process, add_gauss_noise(0.5))
-    meas_in_temp_2 = Measurement(in_temp_process, add_gauss_noise(0.5))
+    meas_in_temp_1 = Measurement(in_temp_process, identity, sigma=0.5)
+    meas_in_temp_2 = Measurement(in_temp_process, identity, sigma=0.5)
     temp_device_1 = BasicDevice("temp1", meas_in_temp_1, 0, "temperature", {"room_id": room_id, "sensor_id": "1"})
     if args.kill_after is not None:
         temp_device_1 = DoomedDevice("temp1", temp_device_1, args.kill_after)
@@ -85,7 +86,7 @@ def create_room(env: Environment, room_id: str,
 
     # CO2 level
     co2_emission_process = env.add_process(
-        TransformedProcess(num_people, lambda x: co2_inc_per_people * x)
+        TransformedProcess.scale(num_people, co2_inc_per_people)
     )
 
     co2_ambient_process = env.add_process(IntegratedProcess(
@@ -94,7 +95,7 @@ def create_room(env: Environment, room_id: str,
 
     co2_process = env.add_process(SumProcess([co2_ambient_process, co2_emission_process]))
 
-    meas_co2 = Measurement(co2_process, add_gauss_noise(10))
+    meas_co2 = Measurement(co2_process, identity, sigma=10)
     env.add_device(BasicDevice("co2", meas_co2, 0, "co2", {"room_id": room_id, "sensor_id": "3"}))
 
 
@@ -124,4 +125,4 @@ for i in range(n_rooms):
         co2_mean_increase=10.0 if args.co2 else -0.1
     )
 
-env.run_influx(args.dt, "config.ini", "smart_uni")
\ No newline at end of file
+asyncio.run(env.run_influx(args.dt, "config.ini", "smart_uni"))
\ No newline at end of file
@@ -1,7 +1,24 @@
 from abc import ABC, abstractmethod
 from typing import Union
-from numpy.random import random, poisson, randn
+from numba import njit
+from numpy.random import random
 from typing import List, Callable
+import numpy as np
+
+
+# standard normal samples are drawn in bulk and handed out one by one by _draw_normal
+_rng = np.random.default_rng()
+_noise_buf = _rng.standard_normal(1 << 16)
+_noise_i = 0
+
+
+def _draw_normal() -> float:
+    global _noise_i
+    x = _noise_buf[_noise_i]
+    _noise_i = (_noise_i + 1) & 0xFFFF
+    if _noise_i == 0:
+        _rng.standard_normal(out=_noise_buf)
+    return x
 
 
 class Process(ABC):
@@ -17,6 +34,19 @@ class Process(ABC):
         return
 
 
+class ArrayProcess(Process):
+    """
+    A process whose value can be stored in the values array of an owner (e.g. an Environment).
+    Once bound to an owner, the process is stepped in bulk by the owner instead of its own step().
+    """
+    owner = None
+    _soa_idx = 0
+
+    def bind(self, owner, idx: int):
+        self.owner = owner
+        self._soa_idx = idx
+
+
 class ConstantProcess(Process):
     def __init__(self, value: Union[float, int]):
         self.value = value
@@ -28,6 +58,19 @@ class ConstantProcess(Process):
         return self.value
 
 
+@njit(cache=True)
+def _bd_step(value: int, lam: float, mu: float, limit: int) -> int:
+    # birth/death number in a time window ~ poisson(birth/death_rate)
+    value += np.random.poisson(lam)
+    if limit > 0:
+        value = min(limit, value)
+    return max(0, value - np.random.poisson(mu))
+
+
+# compile at import instead of in the first time step
+_bd_step(0, 0.0, 0.0, 0)
+
+
 class BirthDeathProcess(Process):
     """
     A discretized birth and death process.
@@ -42,34 +85,29 @@ class BirthDeathProcess(Process):
         self.limit = limit
 
     def step(self):
-        # birth/death number in a time window ~ poisson(birth/death_rate)
-        _lambda = self.birth_rate.get()
-        n_birth = poisson(_lambda)
-        _mu = self.death_rate.get()
-        n_death = poisson(_mu)
-        self.value = self.value+n_birth
-        if self.limit > 0:
-            self.value = min(self.limit, self.value)
-        self.value = max(0, self.value-n_death)
+        self.value = _bd_step(self.value, float(self.birth_rate.get()), float(self.death_rate.get()), self.limit)
 
     def get(self) -> float:
         return self.value
 
 
-class GaussianNoiseProcess(Process):
+class GaussianNoiseProcess(ArrayProcess):
     def __init__(self, mean: float, std: float):
         self.mean = mean
         self.std = std
-        self.value = std*randn()+mean
+        self.value = std*_draw_normal()+mean
 
     def step(self):
-        self.value = self.std*randn()+self.mean
+        if self.owner is None:
+            self.value = self.std*_draw_normal()+self.mean
 
     def get(self) -> float:
+        if self.owner is not None:
+            return self.owner._all_values[self._soa_idx]
         return self.value
 
 
-class PwConstantProcess(Process):
+class PwConstantProcess(ArrayProcess):
     """
     A piecewise constanct process, determined by the values and lengths of the constant parts.
     The process can be made seasonal, meaning that it will loop back to 0 at the last specified timestep.
@@ -80,36 +118,39 @@ class PwConstantProcess(Process):
         self.phase_lengths = phase_lengths
         self.values = values
         self.seasonal = seasonal
+        # the value at each timestep of a period
+        self._table = np.repeat(np.asarray(values, dtype=np.float64), phase_lengths)
+        self._period = self._table.shape[0]
         self.t = 0
-        self.phase = 0
-        self.value = values[0]
+        self.value = self._table[0]
 
     def step(self):
-        self.t += 1
-        if self.t > self.phase_lengths[self.phase]:
-            self.phase += 1
-            self.t = 0
-
-            # TODO: non-seasonal case
-            if self.seasonal and self.phase > len(self.values)-1:
-                self.phase = 0
-                self.t = 0
-            self.value = self.values[self.phase]
-    pass
+        if self.owner is not None:
+            return
+        if self.seasonal:
+            self.t = (self.t + 1) % self._period
+        else:
+            self.t = min(self.t + 1, self._period - 1)
+        self.value = self._table[self.t]
 
     def get(self) -> float:
+        if self.owner is not None:
+            return self.owner._all_values[self._soa_idx]
         return self.value
 
 
-class IntegratedProcess(Process):
+class IntegratedProcess(ArrayProcess):
     def __init__(self, base_process: Process, offset: float = 0.0):
         self.value = base_process.get() + offset
         self.base_process = base_process
 
     def step(self):
-        self.value += self.base_process.get()
+        if self.owner is None:
+            self.value += self.base_process.get()
 
     def get(self) -> float:
+        if self.owner is not None:
+            return self.owner._all_values[self._soa_idx]
         return self.value
 
 
@@ -127,9 +168,23 @@ class ReplayedProcess(Process):
         return self.samples[self.t]
 
 
+def _array_indices(components: List[Process]):
+    """
+    Returns the owner and the indices of the components in its values array if all of them are bound
+    to the same owner, otherwise (None, None).
+    """
+    if not components or not all(isinstance(c, ArrayProcess) and c.owner is not None for c in components):
+        return None, None
+    owner = components[0].owner
+    if any(c.owner is not owner for c in components):
+        return None, None
+    return owner, np.array([c._soa_idx for c in components], dtype=np.intp)
+
+
 class SumProcess(Process):
     def __init__(self, components: List[Process]):
         self.components = components
+        self._owner, self._idx = _array_indices(components)
 
     def step(self):
         # the component processes must be stepped themselves;
@@ -138,17 +193,22 @@ class SumProcess(Process):
         pass
 
     def get(self) -> float:
-        return sum([c.get() for c in self.components])
+        if self._owner is not None:
+            return float(self._owner._all_values[self._idx].sum())
+        return sum(c.get() for c in self.components)
 
 
 class ProductProcess(Process):
     def __init__(self, components: List[Process]):
         self.components = components
+        self._owner, self._idx = _array_indices(components)
 
     def step(self):
         pass
 
     def get(self) -> float:
+        if self._owner is not None:
+            return float(self._owner._all_values[self._idx].prod())
         res = 1.0
         for c in self.components:
             res *= c.get()
@@ -187,3 +247,24 @@ class TransformedProcess(Process):
 
     def get(self) -> float:
         return self.transformation(self.base_process.get())
+
+    @staticmethod
+    def scale(base_process: Process, k: float) -> Process:
+        return ScaledProcess(base_process, k)
+
+
+class ScaledProcess(Process):
+    """
+    The base process multiplied by a constant. Prefer it to a TransformedProcess with a scaling function,
+    as it saves the call of the function.
+    """
+
+    def __init__(self, base_process: Process, k: float):
+        self.base_process = base_process
+        self.k = k
+
+    def step(self):
+        pass
+
+    def get(self) -> float:
+        return self.k * self.base_process.get()
@@ -1,11 +1,12 @@
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS, ASYNCHRONOUS
-from datetime import datetime, timedelta
-from time import sleep
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import WriteOptions
+from influxdb_client.domain.write_precision import WritePrecision
 import pandas as pd
 
 data = pd.read_csv("areas.csv")
 piv = data.pivot(index="TIME",  columns="AREA NAME", values="MW")
+# the rows are written at once, so they are timestamped with their own time instead of the time of writing
+piv.index = pd.to_datetime(piv.index, utc=True)
 tags = {
     "host": "simulator",
     "name": "device",
@@ -15,15 +16,20 @@ tags = {
 
 
 # alternatively: client = InfluxDBClient(url="localhost:8086", token="INSERT TOKEN HERE", org="InfluxData")
-client = InfluxDBClient.from_config_file("config.ini")
-writer = client.write_api(write_options=SYNCHRONOUS)
-for (idx, cols) in piv.iterrows():
-    time = datetime.now()
-    point = Point("modbus")
-    for (key, val) in cols.to_dict().items():
-        point.field(key, 0.0 if(val == 9999) else val)
-    for (key, val) in tags.items():
-        point.tag(key, val)
-    writer.write("node8", record=point)
-    print(point.to_line_protocol())
-    sleep(2)
+client = InfluxDBClient.from_config_file("config.ini", enable_gzip=True)
+# the rows are collected into batches of up to 5000 points and sent in the background,
+# flushed at least every second
+writer = client.write_api(write_options=WriteOptions(batch_size=5000, flush_interval=1_000))
+# 9999 marks a missing reading
+piv = piv.replace(9999, 0.0)
+# the tags are constant columns of the frame, each row is serialized into one point
+for (key, val) in tags.items():
+    piv[key] = val
+# the readings are half-hourly, second precision timestamps are exact
+writer.write("node8", record=piv, data_frame_measurement_name="modbus", data_frame_tag_columns=list(tags.keys()),
+             write_precision=WritePrecision.S)
+print(f"{len(piv)} points written")
+
+# flush the pending batches
+writer.close()
+client.close()